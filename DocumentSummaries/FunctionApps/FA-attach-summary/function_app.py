@@ -35,34 +35,89 @@
 # pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals, too-many-branches, too-many-statements
 
 import os
-import sys
-import json
-import math
+import hashlib
 import uuid
 import logging
 import threading
-import queue
+import functools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from timeit import default_timer as timer
-from io import StringIO, BytesIO
 from datetime import datetime as dt
-import pytz
+from zoneinfo import ZoneInfo
 import extract_msg
+import orjson
 import azure.functions as func
-from PyPDF2 import PdfReader
+import pypdfium2 as pdfium
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
-from azure.cosmos import CosmosClient
+from azure.core import MatchConditions
+from azure.cosmos import CosmosClient, exceptions
 from azure.ai.textanalytics import TextAnalyticsClient
 from azure.storage.blob import BlobServiceClient
-from tenacity import retry, stop_after_delay, wait_exponential, before_log
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.polling.base_polling import BadStatus, OperationFailed
+from tenacity import retry, retry_if_exception, stop_after_delay, wait_exponential_jitter, before_log
 
 AZURE_COSMOS_DATABASE_NAME = os.environ.get("AZURE_COSMOS_DATABASE_NAME")
 AZURE_COSMOS_CONTAINER_NAME = os.environ.get("AZURE_COSMOS_CONTAINER_NAME") 
 
+# Whether the full text extracts (fulltextextract and pypdf2_text_extract) are stored in the Cosmos DB records
+#   Set STORE_FULLTEXT to false to only keep the summary, file markings, and metadata, which keeps the records small
+STORE_FULLTEXT = os.environ.get("STORE_FULLTEXT", "true").lower() == "true"
+FULLTEXT_PROPERTIES = ('fulltextextract', 'pypdf2_text_extract')
+
+# The per-page copy of the pypdfium2 text extract (pypdf2_fulltext_by_page) is only built for PDFs smaller than this size in bytes
+#   For larger PDFs it's usually dropped again by the record size check, and it's never needed when the full text isn't stored
+PYPDF2_BY_PAGE_MAX_BLOB_SIZE = 524288
+
+# Maximum time in seconds for the pypdfium2 text extract, including the wait for another extraction to release PDFium
+PYPDF2_EXTRACTION_TIMEOUT = 60
+
+# Record properties generated from the file contents, which are copied to the records of other files with the same contents
+CONTENT_PROPERTIES = ('fulltextextract', 'pypdf2_text_extract', 'filemarkings', 'abstractsummary', 'abstractsummary_parts', 'textextract_metadata', 'summarization_metadata')
+
+# File extensions of the files handled as PDFs (lowercase), which also get the local pypdfium2 text extract
+PDF_EXTS = frozenset({'.pdf'})
+
+# Record properties checked in an existing record, paired with the name of the content that needs to be generated again when the property is missing or empty
+RECORD_CONTENT_CHECKS = (('fulltextextract', 'text'), ('abstractsummary', 'summary'))
+
+# Azure AI Language limits for a single abstractive summary request
+#   The service rejects requests with more than 125,000 characters across all of their documents, so the character cap matches that limit
+SUMMARY_BATCH_MAX_DOCUMENTS = 25
+SUMMARY_BATCH_MAX_CHARACTERS = 125000
+
+# Maximum number of email attachments uploaded to Blob Storage at the same time
+ATTACHMENT_UPLOAD_MAX_WORKERS = 8
+# Attachments larger than the single upload size are uploaded in blocks, with up to ATTACHMENT_UPLOAD_MAX_CONCURRENCY blocks of each attachment in flight
+#   The SDK default sends anything up to 64 MB in a single request
+ATTACHMENT_UPLOAD_MAX_SINGLE_PUT_SIZE = 4 * 1024 * 1024
+ATTACHMENT_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+ATTACHMENT_UPLOAD_MAX_CONCURRENCY = 4
+
+# Set timezone to East Coast for easily readable timestamps within logging messages (doesn't affect the log's automatic timestamps)
+#   Loaded once per instance with the standard library zoneinfo module rather than on every invocation
+TZ = ZoneInfo("America/New_York")
+# Format of the timestamps written to the log and to the Cosmos DB records
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %f'
+
 app = func.FunctionApp()
 
-## Define global logger for use in @retry decorators
+## Define global logger with Azure context for use in @retry decorators
+#   The level is set once per instance rather than on every invocation
 logger = logging.getLogger('azure')
+# Set Log Level - if more troubleshooting needed, set to logging.DEBUG, otherwise set to logging.INFO
+logger.setLevel(logging.INFO)
+
+## Uncomment below lines to output log info to terminal (useful when developing and testing locally)
+# stdout_handler = logging.StreamHandler(stream=sys.stdout)
+# logger.addHandler(stdout_handler)
+
+# Lock around the creation of the service clients shared across invocations (see shared_client)
+_CLIENTS_LOCK = threading.Lock()
+
+# PDFium isn't thread-safe, so calls into it from concurrent invocations are serialized with this lock
+_PDFIUM_LOCK = threading.Lock()
 
 # Blob input trigger binding
 @app.blob_trigger(arg_name="blobtriggerfile",
@@ -70,50 +125,33 @@ logger = logging.getLogger('azure')
                   path="raw/email_attachments/{subPath}/{name}",
                   connection="datalake_STORAGE") 
 
-# Cosmos DB output binding
-@app.cosmos_db_output(arg_name="cosmodocsout", 
-                      database_name=AZURE_COSMOS_DATABASE_NAME,
-                      container_name=AZURE_COSMOS_CONTAINER_NAME,
-                      create_if_not_exists=False,
-                      connection="cosmosdb_CONNECTION")
-
 # Initial function to verify file extension of incoming files before passing to primary function
-def func_app_email_attachment_summary_main(blobtriggerfile: func.InputStream, cosmodocsout: func.Out[func.Document], context: func.Context):
+def func_app_email_attachment_summary_main(blobtriggerfile: func.InputStream, context: func.Context):
     file_extension = os.path.splitext(blobtriggerfile.name)[1].lower()
     dirname = os.path.dirname(blobtriggerfile.name)
     filename = os.path.basename(blobtriggerfile.name)
     source_email = f"{os.path.split(os.path.dirname(blobtriggerfile.name))[1]}.msg"
-    allowable_extensions = ['.pdf', '.doc', '.docx', '.txt', '.msg']
     if "/Archive" in dirname:
         logging.info(f"{filename} is in Archive directory {dirname} and will be excluded. Stopping function.")
         return
-    if file_extension.lower() in allowable_extensions:
+    if file_extension in TEXT_EXTRACTORS:
         logging.info(f"{filename} is a PDF or Word Doc, beginning file processing")
-        func_app_email_attachment_summary(blobtriggerfile, cosmodocsout, context, filename, dirname, file_extension, source_email)
+        func_app_email_attachment_summary(blobtriggerfile, context, filename, dirname, file_extension, source_email)
     else:
         logging.info(f"{filename} is not a PDF or a Word Document, skipping file processing")
         return
 
 
 # Primary function
-def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodocsout: func.Out[func.Document], context: func.Context, filename, dirname, file_extension, source_email):
-    # Set timezone to East Coast for easily readable timestamps within logging messages (doesn't affect the log's automatic timestamps)
-    tz = pytz.timezone("America/New_York")
+def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, context: func.Context, filename, dirname, file_extension, source_email):
     # Acquire start time of function
-    start_time = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+    start_time = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
     # Start timer
     start = timer()
 
     # Generate Unique ID
     unique_id = str(uuid.uuid4())
 
-    # Set Log Level - if more troubleshooting needed, set to logging.DEBUG, otherwise set to logging.INFO
-    logger.setLevel(logging.INFO)
-
-    ## Uncomment below lines to output log info to terminal (useful when developing and testing locally)
-    # stdout_handler = logging.StreamHandler(stream=sys.stdout)
-    # logger.addHandler(stdout_handler)
-
     #filename = os.path.basename(blobtriggerfile.name)
     #dirname = os.path.dirname(blobtriggerfile.name)
 
@@ -126,11 +164,8 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
 
     try:
         
-        # Initialize Cosmos DB connection and client
-        cosmosdb_conn = os.environ.get("cosmosdb_CONNECTION")
-        cosmos_client = CosmosClient.from_connection_string(cosmosdb_conn)
-        cosmos_db = cosmos_client.get_database_client(AZURE_COSMOS_DATABASE_NAME)
-        cosmos_container = cosmos_db.get_container_client(AZURE_COSMOS_CONTAINER_NAME)
+        # Get the Cosmos DB container client (created once per instance and reused across invocations)
+        cosmos_container = cosmos_container_client()
         
         # Query Cosmos DB for existing records for the incoming blob name
         # Note - query is on full blob name, not just the file name, as attachments may not have unique file names
@@ -143,7 +178,11 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         logging.info(f"Cosmos DB query returned {record_count} results for {filename}\n")
         
         # Read the blob file into a bytes object
+        #   The trigger binding has already buffered the whole blob and its stream isn't seekable,
+        #   so this single bytes object is shared by every extractor instead of re-wrapping it in new streams
         blob_data = blobtriggerfile.read()
+        # Hash the file contents so copies of the same file uploaded under other names can reuse the results
+        content_sha256 = hashlib.sha256(blob_data).hexdigest()
         
         # Initialize variables - defaults for files without an existing Cosmos DB record
         text_missing_flag = True
@@ -152,14 +191,8 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         record_exists = False
         record_version = 1
 
-        # Set the default based on whether the incoming file is a pdf or not
-        pypdf2_missing_flag = file_extension.lower() == '.pdf'
-
-        # # Get the connection strings and other secrets from environment variables in local.settings.json
-        form_recognizer_key = os.getenv('FORM_RECOGNIZER_KEY')
-        form_recognizer_endpoint = os.getenv('FORM_RECOGNIZER_ENDPOINT')
-        ai_language_key = os.getenv('AI_LANGUAGE_KEY')
-        ai_language_endpoint = os.getenv('AI_LANGUAGE_ENDPOINT')
+        # Set the default based on whether the incoming file is a pdf or not (and whether the extract will be stored)
+        pypdf2_missing_flag = STORE_FULLTEXT and file_extension in PDF_EXTS
 
         # Check for existance of Cosmos DB record for incoming file name
         if record_count <= 0:
@@ -170,7 +203,7 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
             #  Update variables accordingly
             record_exists = True
             for item in cosmosdocsin:
-                dict_output, text_missing_flag, summary_missing_flag, pypdf2_missing_flag, filemarkings_missing_flag = record_contents_check(item, filename)
+                dict_output, text_missing_flag, summary_missing_flag, pypdf2_missing_flag, filemarkings_missing_flag = record_contents_check(item, filename, file_extension)
                 # Get version of existing record
                 record_version = dict_output["record_version"]
                 logging.info(f"{record_count} record found for file '{filename}'. Record version is {record_version}. Processing...\n")
@@ -203,36 +236,23 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
             return
         
         # Initialize the output structure if there is not existing record for the file
+        #   Only the properties that apply to every file are created here, the rest are added as they are generated
         if not record_exists:
-            dict_output = {
-                "id": unique_id,
-                "filename": filename,
-                "blobname": blobtriggerfile.name,
-                "filepath": dirname,
-                "filetype": file_extension,
-                "source_email": source_email,
-                "email_attachment": "True",
-                "abstractsummary": '',
-                "fulltextextract": '',
-                "textextract_metadata": {
-                    "fulltextextract_length": '',
-                    "fulltextextract_status": '',
-                    "document_pages": ''},
-                "summarization_metadata":{
-                },
-                "timestamps": {
-                    "function_start": '',
-                    "extraction_start": '',
-                    "extraction_finish": '',
-                    "extraction_duration": ''
-                },
-                "pypdf2_text_extract": '',
-                "record_version": record_version,
-                "current_version_invocation_id": context.invocation_id
-            }
-
-            # Set the function start time for new and existing/updating records
-            dict_output["timestamps"]["function_start"] = start_time
+            dict_output = new_record(unique_id, filename, blobtriggerfile.name, dirname, file_extension, source_email, record_version, context.invocation_id, start_time)
+
+        # Record the hash of the file contents, so later copies of the same file can reuse this record's results
+        dict_output["content_sha256"] = content_sha256
+
+        # If a completed record already exists for another file with the exact same contents (e.g. the same file uploaded under another name),
+        #   copy its results instead of sending the file through the AI services again
+        #   Emails are always processed since their attachments are saved under the email's own file name
+        if not record_exists and file_extension != '.msg':
+            duplicate_record = find_duplicate_record(cosmos_container, content_sha256, file_extension)
+            if duplicate_record is not None:
+                logging.info(f"Filename: {filename} has the same contents as {duplicate_record.get('filename')} (record {duplicate_record['id']}). Copying its results to the new record. Exiting function.\n")
+                copy_content_properties(duplicate_record, dict_output)
+                write_record(cosmos_container, dict_output)
+                return
 
     #################################
     #### TEXT EXTRACTION SECTION ####
@@ -242,54 +262,26 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         if text_missing_flag:
             
             # Get timestamp before text extraction starts
-            txt_extract_start_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+            txt_extract_start_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
 
             logging.info(f"Filename: {filename} Text extraction starting at: {txt_extract_start_timestamp}\n")
 
-            # Initialize Document Analysis Client
-            document_analysis_client = DocumentAnalysisClient(
-                endpoint=form_recognizer_endpoint,
-                credential=AzureKeyCredential(form_recognizer_key)
-            )
-
-            # Acquire the extracted text and metadata
-            #### PDF/DOC(X) ####
-            if file_extension in ['.pdf', '.doc', '.docx']:
-                txt_result_status, txt_result_length, page_count, txt_result, pypdf2_text_dict = text_extraction(blob_data, document_analysis_client, pypdf2_missing_flag)
-                dict_output["textextract_metadata"]["document_pages"] = page_count
-                if pypdf2_missing_flag:
-                    dict_output['pypdf2_text_extract'] = pypdf2_text_dict
-            #### TXT ####
-            elif file_extension == '.txt':
-                txt_result = blob_data.decode('utf-8')
-                txt_result_length = len(txt_result)
-                if txt_result_length > 0:
-                    txt_result_status = 'succeeded'
-                else:
-                    txt_result_status = 'failed'
-                del dict_output["textextract_metadata"]["document_pages"]
-            #### MSG ####
-            elif file_extension == '.msg':
-                dict_output['email_properties']={}
-                txt_result, email_properties = email_extraction(blob_data, filename)
-                dict_output['email_properties']=email_properties
-                txt_result_length = len(txt_result)
-                if txt_result_length > 0:
-                    txt_result_status = 'succeeded'
-                else:
-                    txt_result_status = 'failed'
+            # Acquire the extracted text and metadata with the extractor for the file type
+            extractor = TEXT_EXTRACTORS.get(file_extension)
             #### SOMETHING ELSE SLIPPED THROUGH ####
-            else:
+            if extractor is None:
                 logging.error(f"Filename: {filename} - unable to process file of type {file_extension}")
                 return
-            
-            if file_extension != '.pdf':
-                del dict_output['pypdf2_text_extract']
+            txt_result_status, txt_result_length, txt_result, extras = extractor(blob_data, filename, pypdf2_missing_flag)
+            # Add the file type specific results to the record, document_pages is part of the text extract metadata
+            if 'document_pages' in extras:
+                dict_output["textextract_metadata"]["document_pages"] = extras.pop('document_pages')
+            dict_output.update(extras)
 
             # logging.info(f"Filename: {filename} Retry statistics for text extraction:\n{text_extraction.retry.statistics}\n")
 
             # Get timestamp when results are obtained
-            txt_extract_end_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+            txt_extract_end_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
             extract_end = timer() 
 
             logging.info(f"Filename: {filename} Text extraction completed at {txt_extract_end_timestamp} with status: {txt_result_status}\nText Length: {txt_result_length}\n")
@@ -307,8 +299,8 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         # If the document intelligence text extract exists but the pypdf2 extract is missing and should exist,
         #   run the pypdf2 text extract function and read in the existing fulltextextract and related metadata
         elif not text_missing_flag and pypdf2_missing_flag:
-            logging.info(f"Filename: {filename} Extracting text from PDF using PyPDF2 package")
-            pypdf2_text_dict = pypdf2_text_extraction(blob_data)
+            logging.info(f"Filename: {filename} Extracting text from PDF using pypdfium2 package")
+            pypdf2_text_dict = pypdf2_text_extraction(blob_data, include_by_page=STORE_FULLTEXT and len(blob_data) < PYPDF2_BY_PAGE_MAX_BLOB_SIZE)
             dict_output['pypdf2_text_extract'] = pypdf2_text_dict
             txt_result = dict_output['fulltextextract']
             txt_result_length = dict_output["textextract_metadata"]["fulltextextract_length"]
@@ -320,9 +312,9 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
             txt_result = dict_output['fulltextextract']
             txt_result_length = dict_output["textextract_metadata"]["fulltextextract_length"]
             txt_result_status = dict_output["textextract_metadata"]["fulltextextract_status"]
-            if file_extension == '.pdf':
+            if file_extension in PDF_EXTS:
                 logging.info(f"Filename: {filename} Reading in pypdf2 extract from existing record")
-                pypdf2_text_dict = dict_output['pypdf2_text_extract']
+                pypdf2_text_dict = dict_output.get('pypdf2_text_extract')
 
     ##################################################
     #### DOCUMENT CLASSIFICATION/MARKINGS SECTION ####
@@ -354,15 +346,13 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         if summary_missing_flag and txt_result_status == 'succeeded' and len(txt_result.strip()) > 0:
             
             # Initialize starting time stamps and timers for summary task
-            summary_start_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+            summary_start_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
             summ_start = timer()
 
             logging.info(f"Filename: {filename} Beginning text summarization at: {summary_start_timestamp}\n")
 
-            # Initialize AI Language Client
-            text_analytics_client = TextAnalyticsClient(
-            endpoint=ai_language_endpoint, 
-            credential=AzureKeyCredential(ai_language_key))
+            # Get the AI Language Client (created once per instance and reused across invocations)
+            _, text_analytics_client = service_clients()
      
             #############################
             ##### SHORT TEXT SECTION ####
@@ -377,7 +367,7 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
                 abstractive_summary_result = abstract_summary(text_analytics_client, document)
 
                 # Capture timestamps and durations of the summary call
-                summary_finish_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+                summary_finish_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
                 summ_end = timer()
 
                 logging.info(f"Filename: {filename} Retry statistics for summary:\n{abstract_summary.retry.statistics}\n")
@@ -390,10 +380,11 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
                 # If no errors, append the abstractive summary and metdata to the json output
                 else:
                     # Combines/joins all text from the ItemPaged list object together into a single string
-                    abstr_summary = concat_text_chunks([summary.text for summary in abstractive_summary_result.summaries])  
+                    summaries = abstractive_summary_result.summaries
+                    abstr_summary = "".join(summary.text for summary in summaries)
                     dict_output["abstractsummary"] = abstr_summary
 
-                    input_length = [summary.contexts[0].length for summary in abstractive_summary_result.summaries][0]
+                    input_length = next(iter(summaries)).contexts[0].length
                     dict_output["summarization_metadata"]["text_input_length"] = input_length
                     dict_output["summarization_metadata"]["summary_length"] = len(abstr_summary)
                     dict_output["timestamps"]["summary_start"]=summary_start_timestamp
@@ -415,7 +406,8 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
                 
                 logging.info(f"Filename: {filename} Extracted text is longer than 125,000 characters breaking into smaller chunks to summarize.")
                 
-                final_summary = ""
+                # The summaries of the chunks are collected in a list and joined once they're all done
+                final_summary_parts = []
                 # Initialize the required nested dictionary keys if they don't exist
                 if 'abstractsummary_parts' not in dict_output:
                     dict_output['abstractsummary_parts'] = {}
@@ -426,80 +418,82 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
                 total_summary_text_input_length = 0
                 total_summary_length = 0
 
-                # Loop over the text and break it up into chunks of 125,000 characters or less
+                # Break the text up into chunks of 125,000 characters or less
                 #   End the chunk on the newline character (\n) closest to the 125,000 character count
-                for x in range(math.ceil(len(txt_result)/125000)):
-                    # Set the summary part number for use in dict keys (looks like "summarypart00", "summarypart01", "summarypart19", etc)
-                    summary_part = f"summarypart{str(x).zfill(2)}"
-
-                    summary_part_start_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
-
-                    logging.info(f"Filename: {filename} {summary_part} starting at {summary_part_start_timestamp}")
-
-                    # Initialize the required nested dictionary keys for each summary part
-                    #   dict_output['abstractsummary_parts']['summarypart00']
-                    if summary_part not in dict_output['abstractsummary_parts']:
-                        dict_output['abstractsummary_parts'][summary_part] = {}
-                    #   dict_output['summarization_metadata']['summarypart00']
-                    if summary_part not in dict_output['summarization_metadata']:
-                        dict_output['summarization_metadata'][summary_part] = {}
-                    #   dict_output['timestamps']['summarypart00']
-                    if summary_part not in dict_output['timestamps']:
-                        dict_output['timestamps'][summary_part] = {}
-
-                    # Start the timer for the summary of this chunk of text
-                    summary_part_timer = timer()
+                text_chunks = split_text_chunks(txt_result)
+
+                # Submit the chunks to the summarization service in batches rather than one request per chunk
+                #   Each batch stays within the AI Language limits on documents and characters per request
+                x = 0
+                for text_chunk_batch in batch_text_chunks(text_chunks):
+
+                    summary_part_start_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
 
-                    # Empty and re-initialize the list used to submit text to the Language service
-                    document = []
+                    logging.info(f"Filename: {filename} summarypart{str(x).zfill(2)} to summarypart{str(x + len(text_chunk_batch) - 1).zfill(2)} starting at {summary_part_start_timestamp}")
 
-                    # Find the position of the \n character closest to the end of a substring of the first 125k characters
-                    newline_position = txt_result[0:125000].rfind('\n')
-                    # Add the text between the start and the position returned above to the list
-                    document.append(txt_result[0:newline_position])
-                    # Remove the appended text from the body of the whole text
-                    txt_result = txt_result[newline_position:]
+                    # Start the timer for the summary of this batch of text chunks
+                    summary_part_timer = timer()
 
-                    # Send the text to the abstractive summary service
-                    abstractive_summary_result = abstract_summary(text_analytics_client, document)
+                    # Send the batch of text chunks to the abstractive summary service
+                    #   The results are returned in the same order as the chunks were submitted
+                    abstractive_summary_results = abstract_summary_batch(text_analytics_client, text_chunk_batch)
 
                     # Capture timestamps and durations of the summary call
-                    summary_finish_timestamp = dt.now(tz).strftime('%Y-%m-%d %H:%M:%S %f')
+                    summary_finish_timestamp = dt.now(TZ).strftime(TIMESTAMP_FORMAT)
                     summ_end = timer()
 
-
-                    if abstractive_summary_result.is_error:
-                        logging.error(f"There is an error summarizing file {filename} with code '{abstractive_summary_result.code}' and message '{abstractive_summary_result.message}'")
-                        # Initialize the error dictionary key if it doesn't already exist
-                        if 'error' not in dict_output:
-                            dict_output["error"] = {}
-                        dict_output["error"][f"{summary_part}_error_code"] = abstractive_summary_result.code
-                        dict_output["error"][f"{summary_part}_error_message"] = abstractive_summary_result.message
-                    # If no errors, append the abstractive summary for the chunk of text and associated metdata to the json/dict output
-                    else:
-                        # Combines/joins all text from the ItemPaged list object together into a single string 
-                        #abstr_summary = "".join([summary.text for summary in abstractive_summary_result.summaries])
-                        abstr_summary = concat_text_chunks([summary.text for summary in abstractive_summary_result.summaries])                          
-                        dict_output["abstractsummary_parts"][summary_part] = abstr_summary
-                        # Get the metadata from the result
-                        input_length = [summary.contexts[0].length for summary in abstractive_summary_result.summaries][0]
-                        total_summary_text_input_length += input_length
-                        summary_length = len(abstr_summary)
-                        total_summary_length += summary_length
-                        dict_output["summarization_metadata"][summary_part]["text_input_length"] = input_length
-                        dict_output["summarization_metadata"][summary_part]["summary_length"] = summary_length
-                        dict_output["timestamps"][summary_part][f"{summary_part}_start"]=summary_part_start_timestamp
-                        dict_output["timestamps"][summary_part][f"{summary_part}_finish"]=summary_finish_timestamp
-                        dict_output["timestamps"][summary_part][f"{summary_part}_duration"]=str(summ_end-summary_part_timer)
-
-                        # Append the summary of the chunk to the summaries of previous chunks
-                        final_summary = f"{final_summary} {abstr_summary}"
-
-                        logging.info(f"Document {filename} {summary_part} complete at: {summary_finish_timestamp}")
+                    for abstractive_summary_result in abstractive_summary_results:
+                        # Set the summary part number for use in dict keys (looks like "summarypart00", "summarypart01", "summarypart19", etc)
+                        summary_part = f"summarypart{str(x).zfill(2)}"
+                        x += 1
+
+                        # Initialize the required nested dictionary keys for each summary part
+                        #   dict_output['abstractsummary_parts']['summarypart00']
+                        if summary_part not in dict_output['abstractsummary_parts']:
+                            dict_output['abstractsummary_parts'][summary_part] = {}
+                        #   dict_output['summarization_metadata']['summarypart00']
+                        if summary_part not in dict_output['summarization_metadata']:
+                            dict_output['summarization_metadata'][summary_part] = {}
+                        #   dict_output['timestamps']['summarypart00']
+                        if summary_part not in dict_output['timestamps']:
+                            dict_output['timestamps'][summary_part] = {}
+
+                        if abstractive_summary_result.is_error:
+                            logging.error(f"There is an error summarizing file {filename} with code '{abstractive_summary_result.code}' and message '{abstractive_summary_result.message}'")
+                            # Initialize the error dictionary key if it doesn't already exist
+                            if 'error' not in dict_output:
+                                dict_output["error"] = {}
+                            dict_output["error"][f"{summary_part}_error_code"] = abstractive_summary_result.code
+                            dict_output["error"][f"{summary_part}_error_message"] = abstractive_summary_result.message
+                        # If no errors, append the abstractive summary for the chunk of text and associated metdata to the json/dict output
+                        else:
+                            # Combines/joins all text from the ItemPaged list object together into a single string 
+                            summaries = abstractive_summary_result.summaries
+                            abstr_summary = "".join(summary.text for summary in summaries)
+                            dict_output["abstractsummary_parts"][summary_part] = abstr_summary
+                            # Get the metadata from the result
+                            input_length = next(iter(summaries)).contexts[0].length
+                            total_summary_text_input_length += input_length
+                            summary_length = len(abstr_summary)
+                            total_summary_length += summary_length
+                            dict_output["summarization_metadata"][summary_part]["text_input_length"] = input_length
+                            dict_output["summarization_metadata"][summary_part]["summary_length"] = summary_length
+                            # Every part in a batch shares the timestamps and duration of the batch request
+                            dict_output["timestamps"][summary_part][f"{summary_part}_start"]=summary_part_start_timestamp
+                            dict_output["timestamps"][summary_part][f"{summary_part}_finish"]=summary_finish_timestamp
+                            dict_output["timestamps"][summary_part][f"{summary_part}_duration"]=str(summ_end-summary_part_timer)
+
+                            # Add the summary of the chunk to the summaries of previous chunks
+                            final_summary_parts.append(abstr_summary)
+
+                            logging.info(f"Document {filename} {summary_part} complete at: {summary_finish_timestamp}")
 
                 # Capture the end time of the whole summarization process    
                 end_time = timer()
 
+                # Join the chunk summaries into the final summary, each one preceded by a space as when they were appended one at a time
+                final_summary = "".join(f" {part_summary}" for part_summary in final_summary_parts)
+
                 # Ensure the final appended summary is not blank
                 #   And then write the final summary and metadata to the json/dict output
                 if len(final_summary.strip()) > 0:
@@ -540,33 +534,55 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
                     dict_output['error']['text_extraction_status'] = txt_result_status
                     logging.error(f'No extractable text found in file {filename}, skipping summarization step - skip test 3')
         
-        # Convert/serialize the JSON/dict object to a string for output
-        json_output=json.dumps(dict_output)
+        # Drop the full text extracts from the record when they aren't being stored
+        #   They're only needed during this invocation for summarization and classification
+        if not STORE_FULLTEXT:
+            for fulltext_property in FULLTEXT_PROPERTIES:
+                dict_output.pop(fulltext_property, None)
+
+        # Before serializing, use the lengths of the extracted texts to drop the pypdf2 properties that the size check would drop anyway
+        #   Every character takes at least one byte in the serialized record, so the text lengths are a lower bound on its size,
+        #   so anything dropped here would also have been dropped after serializing, and it's no longer serialized just to be dropped
+        pypdf2_text_extract = dict_output.get('pypdf2_text_extract') or {}
+        minimum_size = len(dict_output.get('fulltextextract', '')) + len(pypdf2_text_extract.get('pypdf2_fulltext', ''))
+        if 'pypdf2_fulltext_by_page' in pypdf2_text_extract and minimum_size + sum(len(page_text) for page_text in pypdf2_text_extract['pypdf2_fulltext_by_page'].values()) > 2097152:
+            logging.warning('Deleting pypdf2_fulltext_by_page from dict_output to reduce size')
+            del pypdf2_text_extract['pypdf2_fulltext_by_page']
+        if pypdf2_text_extract and minimum_size > 2097152:
+            logging.warning('Deleting pypdf2_text_extract from dict_output to reduce size')
+            del dict_output['pypdf2_text_extract']
+
+        # Convert/serialize the JSON/dict object to UTF-8 encoded JSON bytes to check its size
+        #   orjson serializes large text far faster than the json module, and the length of its bytes output is the actual payload size
+        #   The record is only serialized once, properties dropped to reduce the size are subtracted from json_size
+        json_size = len(orjson.dumps(dict_output))
         
-        if sys.getsizeof(json_output) > 2097152:
-            overage_size = sys.getsizeof(json_output) - 2097152
-            logging.warning(f"json output is {sys.getsizeof(json_output)} bytes, which is {overage_size} bytes over the limit")
+        if json_size > 2097152:
+            overage_size = json_size - 2097152
+            logging.warning(f"json output is {json_size} bytes, which is {overage_size} bytes over the limit")
             # Output json contents to Blob Storage as json file with same base name as the input file
             #outputblob.set(json_output)
             if 'pypdf2_text_extract' in dict_output:
                 if 'pypdf2_fulltext_by_page' in dict_output['pypdf2_text_extract']:
                     logging.warning('Deleting pypdf2_fulltext_by_page from dict_output to reduce size')
+                    json_size -= serialized_property_size(dict_output['pypdf2_text_extract'], 'pypdf2_fulltext_by_page')
                     del dict_output['pypdf2_text_extract']['pypdf2_fulltext_by_page']
-                # Convert the dictionary back to json after dropping 'pypdf2_fulltext_by_page'
-                json_output=json.dumps(dict_output)
                 # If the size of the dict is still greater than 2 MB, drop the whole pypdf2_text_extract property from the dict
-                if sys.getsizeof(json_output) > 2097152:
+                if json_size > 2097152:
                     logging.warning('Deleting pypdf2_text_extract from dict_output to reduce size')
+                    json_size -= serialized_property_size(dict_output, 'pypdf2_text_extract')
                     del dict_output['pypdf2_text_extract']
-                    # Convert the dictionary back to json after dropping 
-                    json_output=json.dumps(dict_output)
             
 
         try:    
-            cosmodocsout.set(func.Document.from_json(json_output)) 
+            write_record(cosmos_container, dict_output)
+        except exceptions.CosmosAccessConditionFailedError:
+            # Another invocation (e.g. a duplicate blob trigger) updated the record after it was read, so keep that version
+            logging.warning(f"Filename: {filename} Cosmos DB record was updated by another invocation after it was read. Skipping write.")
+            return
         except Exception as inner_e:
-            logging.error(f"Filename: {filename} An error occurred loading the json_output to the cosmos_db, the size of the json_output is {sys.getsizeof(json_output)}.\n\
-                           Deleting dict_output so main error writes a default one to cosmos db to capture error. Error message: \n{inner_e}", exc_info=True)
+            logging.error(f"Filename: {filename} An error occurred loading the json_output to the cosmos_db, the size of the json_output is {json_size}.\n\
+                           Deleting dict_output so main error writes a default one to cosmos db to capture error. Error message: \n{inner_e}")
             del dict_output
             raise
 
@@ -577,7 +593,6 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         #outputblob.set(json_output)
 
         # Output json contents to Cosmos DB instance
-        #cosmodocsout.set(func.Document.from_json(json_output)) 
         
         end2 = timer()
         logging.info(f"Processing of {filename} complete in {str(end2-start)} seconds. Unique ID is {unique_id}")
@@ -600,9 +615,8 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         if 'error' not in dict_output:
             dict_output['error'] = {} 
         dict_output["error"]["exception"] = str(e)
-        json_output=json.dumps(dict_output)
-        #outputblob.set(json_output)
-        cosmodocsout.set(func.Document.from_json(json_output))
+        #outputblob.set(orjson.dumps(dict_output))
+        cosmos_container_client().upsert_item(dict_output)
 
         # if 'txt_result_status' in locals():
         #     logging.error(f"Retry statistics for text extraction of {filename}:\n{text_extraction.retry.statistics}\n")
@@ -610,71 +624,213 @@ def func_app_email_attachment_summary(blobtriggerfile: func.InputStream, cosmodo
         # if 'abstractive_summary_result' in locals():
         #     logging.error(f"Retry statistics for summary of {filename}:\n{abstract_summary.retry.statistics}\n")
 
+# Function to initialize the output structure for a file without an existing record in Cosmos DB
+#   Properties that only apply to some files (document_pages, pypdf2_text_extract, email_properties) are added when they are generated
+def new_record(unique_id, filename, blobname, dirname, file_extension, source_email, record_version, invocation_id, start_time):
+    return {
+        "id": unique_id,
+        "filename": filename,
+        "blobname": blobname,
+        "filepath": dirname,
+        "filetype": file_extension,
+        "source_email": source_email,
+        "email_attachment": "True",
+        "abstractsummary": '',
+        "fulltextextract": '',
+        "textextract_metadata": {},
+        "summarization_metadata": {},
+        "timestamps": {
+            "function_start": start_time
+        },
+        "record_version": record_version,
+        "current_version_invocation_id": invocation_id
+    }
+
+# Function to turn a client factory into a getter for a client that's shared across invocations
+#   The client is created on first use and then reused across invocations on the same instance,
+#   so the connection setup is only paid once and the connections are kept warm between invocations
+#   The lock keeps concurrent invocations on different threads from creating the client more than once
+def shared_client(create_client):
+    cached_create_client = functools.cache(create_client)
+
+    @functools.wraps(create_client)
+    def get_client():
+        with _CLIENTS_LOCK:
+            return cached_create_client()
+    return get_client
+
+# Function to get the Document Analysis Client and the AI Language Client
+@shared_client
+def service_clients():
+    # Get the connection strings and other secrets from environment variables in local.settings.json
+    document_analysis_client = DocumentAnalysisClient(
+        endpoint=os.getenv('FORM_RECOGNIZER_ENDPOINT'),
+        credential=AzureKeyCredential(os.getenv('FORM_RECOGNIZER_KEY'))
+    )
+    text_analytics_client = TextAnalyticsClient(
+        endpoint=os.getenv('AI_LANGUAGE_ENDPOINT'),
+        credential=AzureKeyCredential(os.getenv('AI_LANGUAGE_KEY'))
+    )
+    return document_analysis_client, text_analytics_client
+
+# Function to get the Cosmos DB container client
+@shared_client
+def cosmos_container_client():
+    cosmos_client = CosmosClient.from_connection_string(os.environ.get("cosmosdb_CONNECTION"))
+    cosmos_db = cosmos_client.get_database_client(AZURE_COSMOS_DATABASE_NAME)
+    return cosmos_db.get_container_client(AZURE_COSMOS_CONTAINER_NAME)
+
+# Function to get the Blob Storage container client that email attachments are saved to
+@shared_client
+def attachments_container_client():
+    blob_service_client = BlobServiceClient.from_connection_string(os.getenv("datalake_STORAGE"), max_single_put_size=ATTACHMENT_UPLOAD_MAX_SINGLE_PUT_SIZE, max_block_size=ATTACHMENT_UPLOAD_BLOCK_SIZE)
+    return blob_service_client.get_container_client(os.getenv('STORAGE_CONTAINER_NAME'))
+
+# Function to write the output record to Cosmos DB
+#   Records read from Cosmos DB are only replaced if they haven't changed since they were read (matched on the record's _etag),
+#   new records are upserted
+def write_record(cosmos_container, dict_output):
+    etag = dict_output.get('_etag')
+    if etag:
+        return cosmos_container.replace_item(item=dict_output['id'], body=dict_output, etag=etag, match_condition=MatchConditions.IfNotModified)
+    return cosmos_container.upsert_item(dict_output)
+
+# Function to find a completed record in Cosmos DB that was generated from a file with the same contents (matched on the SHA-256 hash)
+#   Returns None if there isn't one
+#   Only records for the same file type are matched, so the copied properties (e.g. pypdf2_text_extract) apply to the new file
+def find_duplicate_record(cosmos_container, content_sha256, file_extension):
+    cosmos_query = "SELECT TOP 1 * FROM c WHERE c.content_sha256 = @content_sha256 AND c.filetype = @filetype AND LENGTH(c.abstractsummary) > 0"
+    cosmos_parameters = [{"name": "@content_sha256", "value": content_sha256}, {"name": "@filetype", "value": file_extension}]
+    duplicate_records = list(cosmos_container.query_items(query=cosmos_query, parameters=cosmos_parameters, enable_cross_partition_query=True))
+    return duplicate_records[0] if duplicate_records else None
+
+# Function to get the number of bytes a property takes up in the serialized record (its name, value and separating comma, if any)
+#   Used to update the record size when a property is dropped, instead of serializing the whole record again
+def serialized_property_size(parent_dict, property_name):
+    # Serializing the property on its own adds the 2 braces, which aren't part of its size
+    property_size = len(orjson.dumps({property_name: parent_dict[property_name]})) - 2
+    # When there are other properties, one comma separating the property from them is dropped along with it
+    if len(parent_dict) > 1:
+        property_size += 1
+    return property_size
+
+# Function to copy the results generated from the file contents from one record to another
+#   The full text extracts aren't copied when they aren't being stored
+def copy_content_properties(source_record, dict_output):
+    for content_property in CONTENT_PROPERTIES:
+        if content_property in source_record and (STORE_FULLTEXT or content_property not in FULLTEXT_PROPERTIES):
+            dict_output[content_property] = source_record[content_property]
+    dict_output["content_duplicate_of"] = source_record["id"]
+
 # Function to check if existing record in Cosmos DB for the file
 #  has all the necessary elements (extracted text and summary)
-def record_contents_check(item, filename):
-    file_extension = os.path.splitext(filename)[1]
+#  The file extension is the lowercase one parsed once when the function is triggered
+def record_contents_check(item, filename, file_extension):
     # Convert Cosmos DB record to dict
     dict_output = func.Document.to_dict(item)
     #logging.info(f"\n\nCosmos Item returned: \n{dict_output}\n\n")
-    text_missing_flag = False
-    summary_missing_flag = False
+    # Check whether each property is missing or empty (blank string or dict)
+    missing = {content_name: not dict_output.get(record_property) for record_property, content_name in RECORD_CONTENT_CHECKS}
+    text_missing_flag = missing['text']
+    summary_missing_flag = missing['summary']
     pypdf2_missing_flag = False
     filemarkings_missing_flag = False
-    # Check if the fulltextextract attribute is missing or empty
-    if 'fulltextextract' in item:
-        if len(item['fulltextextract']) <=0:
-            logging.info(f"Text extract is blank for {filename}, extract text\n")
-            text_missing_flag = True
-            #dict_output['fulltextextract'] = 'updated full text extract'
-        else:
-            logging.info(f"Text extract exists for {filename}\n")
-    else:
-        logging.info(f"No text extract key found for {filename}\n")
-        #dict_output['fulltextextract'] = ''
-        text_missing_flag = True
-    # Check to see if the abstractsummary attribute is missing or empty
-    if 'abstractsummary' in item:
-        if len(item['abstractsummary']) <= 0:
-            logging.info(f"No summary found for {filename}\n")
-            #dict_output['abstractsummary'] = 'updated abstract summary'
-            summary_missing_flag = True
-        else:
-            logging.info(f"Summary exists for {filename}\n")
-    else:
-        logging.info(f"No abstractsummary key found for {filename}\n")
-        summary_missing_flag = True
-        #dict_output['abstractsummary'] = ''
     # If the file is a pdf, check to see if it's missing the pypdf2_text_extract contents or record attribute
-    if file_extension == '.pdf':
-        if 'pypdf2_text_extract' in item:
-            if 'pypdf2_fulltext' in item['pypdf2_text_extract']:
-                if len(item['pypdf2_text_extract']['pypdf2_fulltext']) <= 0:
-                    logging.info(f"No pypdf2_text_extract found for {filename}\n")
-                    pypdf2_missing_flag = True
-                else:
-                    logging.info(f"pypdf2_text_extract exists for {filename}\n")
-            else:
-                logging.info(f"No pypdf2_text_extract[pypdf2_fulltext] attribute exists for {filename}\n")
-                pypdf2_missing_flag = True
-        else:
-            logging.info(f"No pypdf2_text_extract attribute found for {filename}\n")
-            pypdf2_missing_flag = True
-    
+    if file_extension in PDF_EXTS:
+        missing['pypdf2_text_extract'] = not (dict_output.get('pypdf2_text_extract') or {}).get('pypdf2_fulltext')
+        pypdf2_missing_flag = missing['pypdf2_text_extract']
+    logging.info(f"Missing or empty record contents for {filename}: {missing}\n")
+
+    # Records written with STORE_FULLTEXT turned off don't keep the text extract,
+    #   so the text only needs to be extracted again when there's still a summary to generate
+    if not STORE_FULLTEXT and 'fulltextextract' not in dict_output and 'fulltextextract_status' in dict_output.get('textextract_metadata', {}):
+        text_missing_flag = summary_missing_flag
+    # The pypdf2 extract is only stored in the record, so there's no need to generate it when it won't be stored
+    pypdf2_missing_flag = pypdf2_missing_flag and STORE_FULLTEXT
+
     return dict_output, text_missing_flag, summary_missing_flag, pypdf2_missing_flag, filemarkings_missing_flag
 
 
-# Retry with exponential backoff, with a cap of 5 minutes
-@retry(reraise=True, stop=stop_after_delay(300),wait=wait_exponential(multiplier=1, min=20, max=30), before=before_log(logger, logging.INFO))
+# Functions to extract the text from each supported file type
+#   Each returns the text extraction status, the text length, the extracted text,
+#   and a dict of file type specific results to add to the record (document_pages, pypdf2_text_extract, email_properties)
+#   They all take the same arguments, so the ones an extractor doesn't use are prefixed with an underscore
+
+#### PDF/DOC(X) ####
+def extract_document_text(blob_data, _filename, pypdf2_missing_flag):
+    # Get the Document Analysis Client (created once per instance and reused across invocations)
+    document_analysis_client, _ = service_clients()
+    if not pypdf2_missing_flag:
+        txt_result_status, txt_result_length, page_count, txt_result = text_extraction(blob_data, document_analysis_client)
+        return txt_result_status, txt_result_length, txt_result, {"document_pages": page_count}
+    # Document Intelligence is network-bound and pypdfium2 is CPU-bound native code,
+    #   so run both extractions at the same time instead of one after the other
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        di_future = executor.submit(text_extraction, blob_data, document_analysis_client)
+        pypdf2_future = executor.submit(pypdf2_text_extraction, blob_data, include_by_page=STORE_FULLTEXT and len(blob_data) < PYPDF2_BY_PAGE_MAX_BLOB_SIZE)
+        txt_result_status, txt_result_length, page_count, txt_result = di_future.result()
+        # The extraction only checks its timeout between pages, so the wait for it is also bounded by the timeout
+        try:
+            pypdf2_text_dict = pypdf2_future.result(timeout=PYPDF2_EXTRACTION_TIMEOUT)
+        except FutureTimeoutError:
+            pypdf2_text_dict = pypdf2_timeout_text_dict(PYPDF2_EXTRACTION_TIMEOUT)
+    finally:
+        # Don't wait for an extraction that's stuck on a page in PDFium before returning
+        executor.shutdown(wait=False)
+    return txt_result_status, txt_result_length, txt_result, {"document_pages": page_count, "pypdf2_text_extract": pypdf2_text_dict}
+
+#### TXT ####
+def extract_plain_text(blob_data, _filename, _pypdf2_missing_flag):
+    txt_result = blob_data.decode('utf-8')
+    return extracted_text_status(txt_result), len(txt_result), txt_result, {}
+
+#### MSG ####
+def extract_email_text(blob_data, filename, _pypdf2_missing_flag):
+    txt_result, email_properties = email_extraction(blob_data, filename)
+    return extracted_text_status(txt_result), len(txt_result), txt_result, {"email_properties": email_properties}
+
+# Function to get the status of a text extraction done within the function, which succeeds if any text was extracted
+def extracted_text_status(txt_result):
+    return 'succeeded' if len(txt_result) > 0 else 'failed'
+
+# Text extraction function for each supported file extension
+#   Also used to verify the extension of incoming files
+TEXT_EXTRACTORS = {
+    '.pdf': extract_document_text,
+    '.doc': extract_document_text,
+    '.docx': extract_document_text,
+    '.txt': extract_plain_text,
+    '.msg': extract_email_text
+}
+
+# Function to decide whether a failed call to the Azure AI services is worth retrying
+#   Connection problems, timeouts, throttling (429) and server errors (5xx) are transient,
+#   other client errors (4xx) and errors raised by this code fail the same way every time, so they aren't retried
+def is_transient_error(exception):
+    if isinstance(exception, (ServiceRequestError, ServiceResponseError)):
+        return True
+    if isinstance(exception, HttpResponseError):
+        # Failed long-running operations are raised by the poller with the polling response attached (usually a 200)
+        #   and the polling error as the cause, so they're recognized by the cause and retried as before
+        if isinstance(exception.__cause__, (OperationFailed, BadStatus)):
+            return True
+        return exception.status_code is None or exception.status_code in (408, 429) or exception.status_code >= 500
+    return False
+
+
+# Retry transient errors with exponential backoff and random jitter, with a cap of 5 minutes
+#   The jitter spreads out the retries of invocations that were throttled at the same time
+@retry(reraise=True, stop=stop_after_delay(300), wait=wait_exponential_jitter(multiplier=5, max=30, jitter=5), retry=retry_if_exception(is_transient_error), before=before_log(logger, logging.INFO))
 # Send file to text extraction service and get a result
-def text_extraction(blob_data, document_analysis_client, pypdf2_missing_flag):
+def text_extraction(blob_data, document_analysis_client):
 
-    bytes_content = BytesIO(blob_data)
     # Send the PDF to Azure AI Document Intelligence to extract text
     # Using "prebuild-read" model instead of "prebuild-layout" because of more reliably formatted output
     # (It does a better job of combining lines into the right sentances and paragraphs)
+    # The bytes are passed directly rather than wrapped in a new stream, so every retry re-sends the same buffer
     di_poller = document_analysis_client.begin_analyze_document(
-        model_id="prebuilt-read", document=bytes_content
+        model_id="prebuilt-read", document=blob_data
     )
     
     # Get the results - will automatically wait/retry until results are available from service
@@ -692,16 +848,11 @@ def text_extraction(blob_data, document_analysis_client, pypdf2_missing_flag):
 
     #first_last_lines = agg_first_last_line(di_result)
 
-    if pypdf2_missing_flag:
-        pypdf2_text_dict = pypdf2_text_extraction(blob_data)
-    else:
-        pypdf2_text_dict = ''
-
-    return txt_result_status, txt_result_length, page_count, txt_result, pypdf2_text_dict
+    return txt_result_status, txt_result_length, page_count, txt_result
 
 
-# Retry with exponential backoff, with a cap of 5 minutes
-@retry(reraise=True, stop=stop_after_delay(300),wait=wait_exponential(multiplier=1, min=30, max=45), before=before_log(logger, logging.INFO))
+# Retry transient errors with exponential backoff and random jitter, with a cap of 5 minutes
+@retry(reraise=True, stop=stop_after_delay(300), wait=wait_exponential_jitter(multiplier=10, max=45, jitter=5), retry=retry_if_exception(is_transient_error), before=before_log(logger, logging.INFO))
 # Send text to abstractive summary service and get a result
 def abstract_summary(text_analytics_client, document):
 
@@ -712,19 +863,61 @@ def abstract_summary(text_analytics_client, document):
     #   This includes a built-in wait and retry function
     document_results = sum_poller.result()
 
-    # Consume the document_results iterator to a list 
-    # If this isn't done, once the output is expanded and iterated over, it's flushed from memory
-    summary_results_list = list(document_results)
-    abstractive_summary_result = summary_results_list[0]  # first document, first result (only result since only 1 document was sent to AI Language Abstract Summarization service)
+    # Take the first result straight from the document_results iterator instead of consuming it to a list
+    #   first document, first result (only result since only 1 document was sent to AI Language Abstract Summarization service)
+    abstractive_summary_result = next(iter(document_results))
 
     return abstractive_summary_result
 
-# Function to concatenate summaries together when text input is >= 125,000 characters
-def concat_text_chunks(chunks):
-    buffer = StringIO()
-    for chunk in chunks:
-        buffer.write(chunk)
-    return buffer.getvalue()
+# Retry transient errors with exponential backoff and random jitter, with a cap of 5 minutes
+@retry(reraise=True, stop=stop_after_delay(300), wait=wait_exponential_jitter(multiplier=10, max=45, jitter=5), retry=retry_if_exception(is_transient_error), before=before_log(logger, logging.INFO))
+# Send a batch of texts to abstractive summary service in a single request and get a result for each of them
+def abstract_summary_batch(text_analytics_client, documents):
+
+    # Send the texts to the abstractive summary service
+    sum_poller = text_analytics_client.begin_abstract_summary(documents)
+
+    # Get the result as an ItemPaged iterator object
+    #   This includes a built-in wait and retry function
+    document_results = sum_poller.result()
+
+    # Consume the document_results iterator to a list, which is in the same order as the submitted documents
+    return list(document_results)
+
+# Function to break text into chunks of 125,000 characters or less (Azure AI Language service limit per document)
+#   Each chunk ends on the newline character (\n) closest to the 125,000 character count
+#   Chunk boundaries are tracked as offsets into the text, so the remaining text is never copied
+def split_text_chunks(txt_result):
+    text_chunks = []
+    offset = 0
+    while offset < len(txt_result):
+        # The rest of the text fits into the last chunk
+        if len(txt_result) - offset <= 125000:
+            end = len(txt_result)
+        else:
+            # Find the position of the \n character closest to the end of the next 125k characters
+            #   rfind searches within the bounds in place, so the 125k character window isn't copied to a new string
+            newline_position = txt_result.rfind('\n', offset, offset + 125000)
+            # If there is no usable \n character, fall back to a hard break at 125k characters
+            end = newline_position if newline_position > offset else offset + 125000
+        # Add the text between the offset and the end position to the list
+        text_chunks.append(txt_result[offset:end])
+        offset = end
+    return text_chunks
+
+# Function to group text chunks into batches that stay within the Azure AI Language service limits per request
+def batch_text_chunks(text_chunks):
+    text_chunk_batch = []
+    batch_length = 0
+    for text_chunk in text_chunks:
+        if text_chunk_batch and (len(text_chunk_batch) >= SUMMARY_BATCH_MAX_DOCUMENTS or batch_length + len(text_chunk) > SUMMARY_BATCH_MAX_CHARACTERS):
+            yield text_chunk_batch
+            text_chunk_batch = []
+            batch_length = 0
+        text_chunk_batch.append(text_chunk)
+        batch_length += len(text_chunk)
+    if text_chunk_batch:
+        yield text_chunk_batch
 
 # Function to match and extract document classification from text 
 # Return the classification and the full line of containing text, if matched, otherwise returns blank dict
@@ -789,94 +982,94 @@ def concat_text_chunks(chunks):
 #         logging.error(f"An error occurred in function agg_first_last_line: {e}", exc_info=True)
 #         raise Exception("Problem in function agg_first_last_line") from e
 
-# Function to extract the text from PDFs using PyPDF2 Python Package
+# Function to extract the text from PDFs using the pypdfium2 Python Package (originally PyPDF2)
 # Intended use of this function is for extracting text from SMS records converted to PDF
-# Based on testing extracting the text via PyPDF2 retains the structure of the text
+# Based on testing extracting the text locally retains the structure of the text
 #     better than extraction using Azure Document Intelligence prebuilt-read model
-def pypdf2_text_extraction(blob_data, timeout=60):
+# The function name and "pypdf2_*" dict keys are kept so existing Cosmos DB records and downstream consumers are unaffected
+def pypdf2_text_extraction(blob_data, timeout=PYPDF2_EXTRACTION_TIMEOUT, include_by_page=False):
     """
     Extract text from a PDF file with a timeout mechanism.
     
     Args:
-        pdf_path (str): Path to the PDF file
-        timeout (int): Maximum time to wait for text extraction in seconds
+        blob_data (bytes): Contents of the PDF file
+        timeout (int): Maximum time to spend on text extraction in seconds, including the wait for the PDFium lock
+        include_by_page (bool): Whether to also return the text of each page in pypdf2_fulltext_by_page
     
     Returns:
-        str: Extracted text or error message
+        dict: Extracted text, page count, and any error message
     """
-    # Queue to store extraction result
-    full_text_queue = queue.Queue()
-    
-    # Exception queue to capture any errors during extraction
-    exception_queue = queue.Queue()
-
     pypdf2_text_dict = {
         "pypdf2_page_count": '',
-        "pypdf2_fulltext": '',
-        "pypdf2_fulltext_by_page": {}
+        "pypdf2_fulltext": ''
     }
+    if include_by_page:
+        pypdf2_text_dict['pypdf2_fulltext_by_page'] = {}
     
+    # The deadline starts before the wait for the PDFium lock, so time spent behind another extraction counts against it
+    extraction_start = timer()
+
     def pdf_extraction_worker():
+        # The timeout is checked between pages, so the extraction stops itself instead of being left running in a background thread
+        pdf = None
         try:
             # Open the PDF file
-            # stream_content = blobtriggerfile.read()
-            bytes_content = BytesIO(blob_data)
-            pdf_reader = PdfReader(bytes_content)
-            # Open the PDF file
+            #   pypdfium2 reads the bytes object directly, so no BytesIO wrapper is needed
+            pdf = pdfium.PdfDocument(blob_data)
                
             # Extract text from all pages
-            full_text = ""
-            #for page in pdf_reader.pages:
-            for page in enumerate(pdf_reader.pages):
-                #logging.info(f'\nPage: {page_num}\n')
-                page_obj = pdf_reader.pages[page[0]]
-                page_text = page_obj.extract_text()
-                full_text += page_text + "\n"
-                pypdf2_text_dict['pypdf2_fulltext_by_page'][f'page_number_{page[0]}'] = page_text
-            pypdf2_text_dict['pypdf2_page_count'] = len(pdf_reader.pages)
+            #   The page texts are collected in a list and joined once at the end, instead of re-copying the whole text for every page
+            page_texts = []
+            for page_num, page in enumerate(pdf):
+                if timer() - extraction_start > timeout:
+                    raise TimeoutError(f"Text extraction timed out after {timeout} seconds")
+                text_page = page.get_textpage()
+                # PDFium separates lines with \r\n, normalize to \n to match the previous PyPDF2 output
+                page_text = text_page.get_text_range().replace('\r\n', '\n')
+                text_page.close()
+                page.close()
+                page_texts.append(page_text)
+                if include_by_page:
+                    pypdf2_text_dict['pypdf2_fulltext_by_page'][f'page_number_{page_num}'] = page_text
+            pypdf2_text_dict['pypdf2_page_count'] = len(pdf)
             
-            # Put the extracted text in the queue
-            full_text_queue.put(full_text.strip())
-        
-        except Exception as e:
-            # Capture any exceptions that occur during extraction
-            exception_queue.put(e)
-            logging.error(f"An error occurred in function 'pdf_extraction_worker': {e}", exc_info=True)
-            raise Exception("Problem in function pdf_extraction_worker") from e
+            return "\n".join(page_texts).strip()
+
+        finally:
+            # Explicitly release the underlying PDFium document handle
+            if pdf is not None:
+                pdf.close()
     
     try:
-        # Create and start the extraction thread
-        extraction_thread = threading.Thread(target=pdf_extraction_worker)
-        extraction_thread.start()
-        
-        # Wait for the thread to complete or timeout
-        extraction_thread.join(timeout)
-        
-        if not full_text_queue.empty():
-            pypdf2_text_dict['pypdf2_fulltext'] = full_text_queue.get()
-        else:
-            pypdf2_text_dict['pypdf2_fulltext'] = 'No text extracted'
+        # PDFium isn't thread-safe, so only one extraction runs at a time on each instance
+        #   The wait for the lock is bounded by the timeout, so an extraction stuck behind another one gives up instead of waiting indefinitely
+        if not _PDFIUM_LOCK.acquire(timeout=timeout):
+            raise TimeoutError(f"Text extraction timed out after {timeout} seconds waiting for PDFium")
+        try:
+            pypdf2_text_dict['pypdf2_fulltext'] = pdf_extraction_worker()
+        finally:
+            _PDFIUM_LOCK.release()
 
-        # Check if the thread is still alive (timed out)
-        if extraction_thread.is_alive():
-            pypdf2_text_dict['pypdf2_timeout_error'] = f"Error: Text extraction timed out after {timeout} seconds"
-            logging.error(f"Error: PyPDF2 text extraction timed out after {timeout} seconds")
-            return pypdf2_text_dict
-        
-        # Check if an exception occurred
-        if not exception_queue.empty():
-            error = exception_queue.get()
-            pypdf2_text_dict['pypdf2_error'] = f"Error during PyPDF2 PDF extraction: {str(error)}"
-            logging.error(f"Error during PyPDF2 PDF extraction: {str(error)}")
-            return pypdf2_text_dict
+    except TimeoutError:
+        pypdf2_text_dict.update(pypdf2_timeout_text_dict(timeout))
 
     except Exception as e:
-        logging.error(f"An error occurred in function pypdf2_text_extraction: {e}", exc_info=True)
-        raise Exception("Problem in function pypdf2_text_extraction") from e
+        pypdf2_text_dict['pypdf2_fulltext'] = 'No text extracted'
+        pypdf2_text_dict['pypdf2_error'] = f"Error during pypdfium2 PDF extraction: {str(e)}"
+        logging.error(f"Error during pypdfium2 PDF extraction: {str(e)}", exc_info=True)
     
-    # Retrieve and return the extracted text
+    # Return the extracted text
     return pypdf2_text_dict
 
+# Function to build the pypdfium2 text extract result for an extraction that timed out
+def pypdf2_timeout_text_dict(timeout):
+    logging.error(f"Error: pypdfium2 text extraction timed out after {timeout} seconds")
+    return {
+        "pypdf2_page_count": '',
+        "pypdf2_fulltext": 'No text extracted',
+        "pypdf2_timeout_error": f"Error: Text extraction timed out after {timeout} seconds"
+    }
+
 # Function to extract email content, email metadata, and email attachments
 # Email attachments are saved back to blob storage to be processed by the email attachment function app
 def email_extraction(blob_data, filename):
@@ -918,19 +1111,17 @@ def email_extraction(blob_data, filename):
         # IF Statement to check whether attachments exist before running code to save them to blob storage
         if msg.attachments:
 
-            # Create blob container client to save attachments
-            storage_connection_string = os.getenv("datalake_STORAGE")
-            storage_container_name = os.getenv('STORAGE_CONTAINER_NAME')
-            blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-            container_client = blob_service_client.get_container_client(storage_container_name)
+            # Get the (cached) blob container client to save attachments
+            container_client = attachments_container_client()
             # Get the name of the email file without the extension to use as the top level folder name the attachments will be saved into            
             base_filename = os.path.splitext(filename)[0]
 
-            # Initialize lists to record attachment file names and blob paths
+            # Initialize lists to record attachment file names and blob paths, and the attachments to upload
             attachment_list = []
             attachment_list_full_path = []
+            attachment_uploads = []
             
-            # Save email attachments to blob storage
+            # Collect the email attachments to save to blob storage
             for attachment in msg.attachments:
                 if attachment.longFilename:
                     logging.info(f"Attachment filename: {attachment.longFilename}")
@@ -940,23 +1131,33 @@ def email_extraction(blob_data, filename):
                     
                     attachment_list.append(attachment.displayName)
                     attachment_list_full_path.append(attachment_name)
-                    # Upload attachment to Blob Storage
-                    blob_client = container_client.get_blob_client(attachment_name)
-                    blob_client.upload_blob(attachment_content, overwrite=True)
-                    
-                    logging.info(f"Uploaded attachment: {attachment_name}")
-
-                    logging.info("Finished processing .msg file and uploading attachments")
+                    attachment_uploads.append((attachment_name, attachment_content))
 
                 else:
                     logging.info("Skipping attachment with None filename.")
 
+            # Upload the attachments to Blob Storage in parallel, since each upload is a separate round trip to the storage account
+            if attachment_uploads:
+                with ThreadPoolExecutor(max_workers=min(len(attachment_uploads), ATTACHMENT_UPLOAD_MAX_WORKERS)) as executor:
+                    upload_futures = [executor.submit(upload_attachment, container_client, attachment_name, attachment_content) for attachment_name, attachment_content in attachment_uploads]
+                    for upload_future in upload_futures:
+                        logging.info(f"Uploaded attachment: {upload_future.result()}")
+
+                logging.info("Finished processing .msg file and uploading attachments")
             
             email_properties['attachment_filenames'] = attachment_list
             email_properties['attachment_blob_names'] = attachment_list_full_path
     
     except Exception as e:
-        logging.error(f"An error occurred in function email_extraction: {e}", exc_info=True)
+        logging.error(f"An error occurred in function email_extraction: {e}")
         raise Exception("Problem in function email_extraction") from e
     
     return email_body, email_properties
+
+# Function to upload an email attachment to Blob Storage
+# Returns the name of the uploaded blob
+def upload_attachment(container_client, attachment_name, attachment_content):
+    blob_client = container_client.get_blob_client(attachment_name)
+    # Passing the length up front saves the SDK from working out the size of the data itself
+    blob_client.upload_blob(attachment_content, overwrite=True, length=len(attachment_content), max_concurrency=ATTACHMENT_UPLOAD_MAX_CONCURRENCY)
+    return attachment_name
@@ -0,0 +1,109 @@
+# Helpers shared by the unit tests of both function apps
+import importlib.util
+import os
+
+from azure.core.exceptions import HttpResponseError
+from azure.core.polling.base_polling import OperationFailed
+
+# Folder holding the function app folders
+_FUNCTION_APPS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Function to load the function_app.py of a function app folder
+#   Both files have the same module name, so each one is loaded under its own name to keep them apart in the same test session
+def load_function_app(app_folder, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(_FUNCTION_APPS_DIR, app_folder, 'function_app.py'))
+    function_app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(function_app)
+    return function_app
+
+
+# Stand-in for the Cosmos DB container client that records the query and returns the given records
+class FakeContainer:
+    def __init__(self, records):
+        self.records = records
+        self.query = None
+        self.parameters = None
+
+    def query_items(self, query, parameters, **kwargs):
+        self.query = query
+        self.parameters = {parameter["name"]: parameter["value"] for parameter in parameters}
+        return iter(self.records)
+
+
+# Stand-in for the async Cosmos DB container client, which hands the records back through an async iterator
+class FakeAsyncContainer(FakeContainer):
+    def query_items(self, query, parameters, **kwargs):
+        super().query_items(query, parameters, **kwargs)
+        return self._iterate_records()
+
+    async def _iterate_records(self):
+        for record in self.records:
+            yield record
+
+
+# Stand-in for an azure.core.rest.HttpResponse, with the parts HttpResponseError reads from it
+class FakeHttpResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.reason = 'Test reason'
+        self.headers = {}
+        self.content_type = 'application/json'
+
+    def text(self, encoding=None):
+        return ''
+
+
+# Function to build the error the azure-core pollers raise when a long-running operation reports that it failed
+#   The poller attaches the polling response (usually a 200) and raises the polling error as the cause
+def failed_operation_error():
+    try:
+        raise OperationFailed('Operation failed or canceled')
+    except OperationFailed as polling_error:
+        try:
+            raise HttpResponseError(response=FakeHttpResponse(200), error=polling_error) from polling_error
+        except HttpResponseError as failed_operation:
+            return failed_operation
+
+
+# Stand-in for the poller of a long-running operation that either raises the given error or returns the given results
+class FakePoller:
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    def result(self):
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return iter(self.outcome)
+
+
+# Stand-in for the async poller, which hands the results back through an async iterator
+class FakeAsyncPoller(FakePoller):
+    async def result(self):
+        results = super().result()
+        return self._iterate_results(results)
+
+    async def _iterate_results(self, results):
+        for result in results:
+            yield result
+
+
+# Stand-in for the Text Analytics client that starts one poller for each of the given outcomes, in order
+class FakeSummaryClient:
+    poller_class = FakePoller
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.requests = []
+
+    def begin_abstract_summary(self, documents):
+        self.requests.append(documents)
+        return self.poller_class(self.outcomes.pop(0))
+
+
+# Stand-in for the async Text Analytics client
+class FakeAsyncSummaryClient(FakeSummaryClient):
+    poller_class = FakeAsyncPoller
+
+    async def begin_abstract_summary(self, documents):
+        return super().begin_abstract_summary(documents)
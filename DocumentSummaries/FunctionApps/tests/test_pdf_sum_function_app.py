@@ -0,0 +1,137 @@
+# Unit tests for the pdf-sum function app
+#   Run from the FunctionApps folder with: python -m unittest discover -s tests
+import asyncio
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from azure.core.exceptions import HttpResponseError
+from tenacity import wait_none
+
+from function_app_fakes import FakeAsyncContainer, FakeAsyncSummaryClient, FakeHttpResponse, failed_operation_error, load_function_app
+
+function_app = load_function_app('FA-pdf-sum', 'pdf_sum_function_app')
+
+
+class FindDuplicateRecordTests(unittest.TestCase):
+
+    def test_skips_records_from_other_file_types_and_the_attachment_app(self):
+        # A record written by the attachment summary function app for the same contents has no file markings,
+        #   so the query has to leave it out along with records for other file types
+        container = FakeAsyncContainer([])
+        duplicate_record = asyncio.run(function_app.find_duplicate_record(container, 'abc123', '.pdf'))
+        self.assertIsNone(duplicate_record)
+        self.assertEqual(container.parameters, {"@content_sha256": 'abc123', "@filetype": '.pdf'})
+        self.assertIn("c.filetype = @filetype", container.query)
+        self.assertIn("IS_DEFINED(c.filemarkings)", container.query)
+        self.assertIn("NOT IS_DEFINED(c.email_attachment)", container.query)
+
+    def test_returns_the_first_matching_record(self):
+        container = FakeAsyncContainer([{"id": 'first'}, {"id": 'second'}])
+        duplicate_record = asyncio.run(function_app.find_duplicate_record(container, 'abc123', '.pdf'))
+        self.assertEqual(duplicate_record["id"], 'first')
+
+
+class IsTransientErrorTests(unittest.TestCase):
+
+    def test_failed_long_running_operation_is_retried(self):
+        failed_operation = failed_operation_error()
+        self.assertEqual(failed_operation.status_code, 200)
+        self.assertTrue(function_app.is_transient_error(failed_operation))
+
+    def test_client_error_is_not_retried(self):
+        self.assertFalse(function_app.is_transient_error(HttpResponseError(response=FakeHttpResponse(400))))
+
+    def test_throttling_is_retried(self):
+        self.assertTrue(function_app.is_transient_error(HttpResponseError(response=FakeHttpResponse(429))))
+
+    def test_summary_is_requested_again_after_the_operation_fails(self):
+        client = FakeAsyncSummaryClient(failed_operation_error(), ['summary result'])
+        summarize = function_app.abstract_summary.retry_with(wait=wait_none())
+        self.assertEqual(asyncio.run(summarize(client, ['text'])), 'summary result')
+        self.assertEqual(client.requests, [['text'], ['text']])
+
+    def test_errors_raised_by_the_function_are_not_retried(self):
+        self.assertFalse(function_app.is_transient_error(ValueError('bad input')))
+
+
+class BatchTextChunksTests(unittest.TestCase):
+
+    # Azure AI Language limits for a single abstractive summary request
+    MAX_REQUEST_CHARACTERS = 125000
+    MAX_REQUEST_DOCUMENTS = 25
+
+    def assert_batches_within_limits(self, text_chunks):
+        batches = list(function_app.batch_text_chunks(text_chunks))
+        for batch in batches:
+            self.assertLessEqual(sum(len(text_chunk) for text_chunk in batch), self.MAX_REQUEST_CHARACTERS)
+            self.assertLessEqual(len(batch), self.MAX_REQUEST_DOCUMENTS)
+        # Every chunk is sent once, in its original order
+        self.assertEqual([text_chunk for batch in batches for text_chunk in batch], text_chunks)
+
+    def test_chunks_of_long_text(self):
+        long_text = ''.join(f'line {line_number} ' + 'x' * (line_number % 300) + '\n' for line_number in range(5000))
+        self.assert_batches_within_limits(function_app.split_text_chunks(long_text))
+
+    def test_many_short_chunks(self):
+        self.assert_batches_within_limits(['x' * 40000] * 7 + ['y' * 100] * 60)
+
+
+class PypdfTextExtractionTests(unittest.TestCase):
+
+    def test_gives_up_waiting_for_another_extraction(self):
+        # Hold the PDFium lock, as a long extraction for another invocation would
+        with function_app._PDFIUM_LOCK:
+            pypdf2_text_dict = function_app.pypdf2_text_extraction(b'%PDF-1.4', timeout=0.05)
+        self.assertEqual(pypdf2_text_dict["pypdf2_fulltext"], 'No text extracted')
+        self.assertIn("pypdf2_timeout_error", pypdf2_text_dict)
+
+    def test_stops_waiting_for_an_extraction_stuck_on_a_page(self):
+        # Stand-in for an extraction that doesn't get back from PDFium to check its timeout
+        def stuck_extraction(blob_data, timeout, include_by_page):
+            time.sleep(0.5)
+        with mock.patch.object(function_app, 'pypdf2_text_extraction', stuck_extraction):
+            pypdf2_text_dict = asyncio.run(function_app.pypdf2_text_extraction_async(b'%PDF-1.4', timeout=0.05))
+        self.assertEqual(pypdf2_text_dict["pypdf2_fulltext"], 'No text extracted')
+        self.assertIn("pypdf2_timeout_error", pypdf2_text_dict)
+
+
+class SharedClientTests(unittest.TestCase):
+
+    def test_client_is_created_once_for_concurrent_invocations(self):
+        created_clients = []
+
+        def create_client():
+            # Give the other threads time to ask for the client while it's being created
+            time.sleep(0.05)
+            created_clients.append(object())
+            return created_clients[-1]
+
+        get_client = function_app.shared_client(create_client)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: get_client(), range(8)))
+        self.assertEqual(len(created_clients), 1)
+        self.assertTrue(all(client is created_clients[0] for client in clients))
+
+
+class SerializedPropertySizeTests(unittest.TestCase):
+
+    def assert_size_matches_serializing_again(self, parent_dict, property_name):
+        full_size = len(function_app.orjson.dumps(parent_dict))
+        property_size = function_app.serialized_property_size(parent_dict, property_name)
+        del parent_dict[property_name]
+        self.assertEqual(full_size - property_size, len(function_app.orjson.dumps(parent_dict)))
+
+    def test_first_property(self):
+        self.assert_size_matches_serializing_again({"a": 'x', "b": {"c": 'y'}, "d": 1}, 'a')
+
+    def test_last_property(self):
+        self.assert_size_matches_serializing_again({"a": 'x', "b": {"c": 'y'}, "d": 1}, 'd')
+
+    def test_only_property(self):
+        self.assert_size_matches_serializing_again({"pypdf2_fulltext_by_page": {"page_number_0": 'caf\u00e9 "text"\n'}}, 'pypdf2_fulltext_by_page')
+
+
+if __name__ == '__main__':
+    unittest.main()
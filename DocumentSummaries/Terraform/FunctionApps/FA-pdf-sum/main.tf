@@ -143,6 +143,7 @@ resource "azurerm_linux_function_app" "linux_function_app" {
     # FORM_RECOGNIZER_KEY            = "@Microsoft.KeyVault(SecretUri=${data.azurerm_key_vault.keyvault.vault_uri}secrets/FORM-RECOGNIZER-KEY-FREE)"
     cosmosdb_CONNECTION            = "@Microsoft.KeyVault(SecretUri=${data.azurerm_key_vault.keyvault.vault_uri}secrets/CONN-${var.cosmos_db_name})"
     datalake_STORAGE               = "@Microsoft.KeyVault(SecretUri=${data.azurerm_key_vault.keyvault.vault_uri}secrets/CONN-${data.azurerm_storage_account.data_lake_01.name})"
+    STORE_FULLTEXT                 = "true"
     BUILD_FLAGS                    = "UseExpressBuild"
     ENABLE_ORYX_BUILD              = "true"
     SCM_DO_BUILD_DURING_DEPLOYMENT = "1"